@@ -7,10 +7,18 @@ blade and comparing it to the original blade performance.
 """
 
 import numpy as np
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 
-import shutil
+import io
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+try:
+    from numba import njit
+except ImportError:  # Numba is optional, the modifiers then run as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 import config  # Import no matter what, it loads up the figure style
 
@@ -18,216 +26,316 @@ import h2s
 
 U = 8  # Tested velocity [m/s]
 
-design_name = "WDR_10_MW"
-save_design = True
-plot_name_1 = f"{design_name}_chord_twist.pdf"
-plot_name_2 = f"{design_name}_forces.pdf"
-
-# %% Load original blade design
-# Read .ae and .htc files
+# Original blade design .ae and .htc files
 ae_file_pathname = r"D:\AE EWEM MSc\T H E S I S\6_code\code repository\my_dtu_10mw\data\DTU_10MW_RWT_ae.dat"
 htc_file_pathname = r"D:\AE EWEM MSc\T H E S I S\6_code\code repository\my_dtu_10mw\DTU_10MW_rigid_hawc2s_flattened.htc"
 
-# Get blade aerodynamic data from the ae.dat file
-ae_data = np.loadtxt(ae_file_pathname, skiprows=2, usecols=(0, 1, 2))
-radius = ae_data[:, 0]  # Span [m]
-chord = ae_data[:, 1]  # Chord length [m]
-rel_thickness = ae_data[:, 2]  # Relative thickness (%)
-
-N = np.size(radius)  # Number of sections
-
 # Where the twist data can be found in the .htc file, and data in ae_dat file
 htc_start_line = 110
 n_sec = 27
 htc_end_line = htc_start_line + n_sec
 ae_start_line = 2
 
-# Get blade twist data from the input .htc file
-twist = np.genfromtxt(htc_file_pathname, skip_header=htc_start_line,
-                      max_rows=27, usecols=(4, 5), comments=";",)
-# Positions at which twist is defined in the .htc file
-twist_radii = twist[:, 0]
-
-# Create a .geo blade equivalent format matrix
-geo_mat = np.zeros([N, 4])
-geo_mat[:, 0] = radius
-geo_mat[:, 1] = np.interp(geo_mat[:, 0], twist[:, 0], twist[:, 1])
-geo_mat[:, 2] = chord
-geo_mat[:, 3] = rel_thickness
+# Manual root twist multipliers, per blade section from the root on, found
+# iteratively to achieve a desired angle of attack on the blade
+# 1st design iteration, angle of attack of -2 degrees until 0.4 of r/R
+# manual_multiplier = [1, 0.80, 0.81, 0.79, 0.55, 0.61, 0.50, 0.45, 0.39, 0.34, 0.32, 0.31, 0.30, 0.3, 0.21, 0.32, 0.17]
+# 2nd design iteration, angle of attack of -2 degrees until 0.25 of r/R
+manual_multiplier_wdr1 = np.array([1, 0.80, 0.81, 0.79, 0.55, 0.61, 0.50,
+                                   0.45, 0.39, 0.34, 0.32, 0.31, 0.30],
+                                  dtype=np.float64)
+
+# The twist is the sixth value of a `sec` line in the .htc file, before the `;`
+htc_twist_pattern = re.compile(r"^(\s*(?:\S+\s+){5})[^\s;]+")
+
+
+@njit(cache=True, fastmath=True)
+def apply_modifier(col, mult, add):
+    """Add `add * mult` to the blade column `col` in place."""
+    for i in range(col.shape[0]):
+        col[i] = col[i] + add * mult[i]
+
+
+def write_files(contents):
+    """Write the text files in `contents`, a dict of paths and their lines,
+    with a single write call each.
+
+    All files are written to temporary files first, which only then replace
+    the actual files. A failed write thus leaves the old files untouched and
+    no temporary files behind.
+    """
+    tmp_paths = {path: f"{path}.tmp" for path in contents}
+    try:
+        for path, lines in contents.items():
+            buf = io.StringIO()
+            buf.writelines(lines)
+            with open(tmp_paths[path], 'w') as file:
+                file.write(buf.getvalue())
+        for path, tmp_path in tmp_paths.items():
+            os.replace(tmp_path, path)
+    finally:
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-# Plot chord and twist
-R = geo_mat[:, 0][-1]  # Maximum radius [m]
-radius_nd = geo_mat[:, 0] / R  # Non-dimensionalised radius r/R [-]
 
-fig, ax = plt.subplots(2, 1, sharex=True)
-ax[0].plot(radius_nd, geo_mat[:, 2], label="Baseline")
-ax[0].set_ylabel("Chord [m]")
-
-ax[1].plot(radius_nd, geo_mat[:, 1], label="Baseline")
-ax[1].set_ylabel("Twist [deg]")
-ax[1].set_xlabel("Blade radius r/R [-]")
+# %% Load original blade design
+@lru_cache(maxsize=4)
+def load_inputs(ae_path, htc_path, mtime):
+    """Parse the original blade design from its .ae and .htc files.
+
+    `mtime` only keys the cache, so that a file changed on disk is parsed
+    again. The returned arrays are shared between calls, so they are made
+    read-only.
+    """
+    # Get blade aerodynamic data from the ae.dat file
+    ae_data = np.loadtxt(ae_path, skiprows=ae_start_line, usecols=(0, 1, 2))
+    radius = ae_data[:, 0]  # Span [m]
+    chord = ae_data[:, 1]  # Chord length [m]
+    rel_thickness = ae_data[:, 2]  # Relative thickness (%)
+
+    # Header lines and columns of the ae.dat file after the relative
+    # thickness, kept unchanged
+    with open(ae_path, 'r') as ae_file:
+        ae_header = tuple(next(ae_file) for _ in range(ae_start_line))
+    ae_data_extra_cols = np.loadtxt(ae_path, skiprows=ae_start_line,
+                                    dtype=str, ndmin=2)[:, 3:]
+
+    # Get blade twist data from the input .htc file, read once and reused
+    # when writing the new .htc file
+    with open(htc_path, 'r') as htc_file:
+        htc_lines = tuple(htc_file.readlines())
+    twist = np.array([[float(x) for x in line.split(";")[0].split()[4:6]]
+                      for line in htc_lines[htc_start_line:htc_end_line]])
+    # Positions at which twist is defined in the .htc file
+    twist_radii = twist[:, 0]
+
+    # Create a .geo blade equivalent format matrix
+    geo_mat = np.column_stack((radius,
+                               np.interp(radius, twist[:, 0], twist[:, 1]),
+                               chord,
+                               rel_thickness))
+
+    R = geo_mat[:, 0][-1]  # Maximum radius [m]
+    radius_nd = geo_mat[:, 0] / R  # Non-dimensionalised radius r/R [-]
+
+    blade = {
+        "geo_mat": geo_mat,
+        "radius_nd": radius_nd,
+        # Radial shape functions shared by the blade modifiers
+        "cos_pi_r": np.cos(np.pi * radius_nd),  # From 1 at root to -1 at tip
+        "r_minus_one": radius_nd - 1.0,  # From -1 at root to 0 at tip
+        "twist_radii": twist_radii,
+        "htc_lines": htc_lines,
+        "ae_header": ae_header,
+        "ae_data_extra_cols": ae_data_extra_cols,
+    }
+    for key in ["geo_mat", "radius_nd", "cos_pi_r", "r_minus_one",
+                "twist_radii", "ae_data_extra_cols"]:
+        blade[key].setflags(write=False)
+
+    return blade
+
+
+def load_blade(ae_path=ae_file_pathname, htc_path=htc_file_pathname):
+    """Load the original blade design, parsing the files only if they are
+    not cached yet or have changed since."""
+    mtime = (os.path.getmtime(ae_path), os.path.getmtime(htc_path))
+    return load_inputs(ae_path, htc_path, mtime)
 
 
 # %% Changing the design
-working_mat = geo_mat.copy()
-
-# To change the DTU10MW blade design, use any combination of the below blade
-# modifiers by  turning them 'on' by setting them to `True`
-
-
-# Linearly changing addition to chord length
-root_linear_chord_addition = True
-if root_linear_chord_addition:
-    linear_multiplier = radius_nd - 1.0
-    chord_addition = -1.0  # [m]
-    changes_until = 0.25  # r/R until which we change the chord
-    i = 0
-    for radius in radius_nd:
-        if radius <= changes_until:
-            working_mat[i, 2] = working_mat[i, 2] - \
-                chord_addition * linear_multiplier[i]
-        i += 1
-
-# Negative cosine alteration to chord length, at the tip
-tip_cos_chord_addition = False
-if tip_cos_chord_addition:
-    ncos_multiplier = - np.cos(radius_nd * np.pi)
-    chord_addition = - 0.5  # [m]
-    changes_from = 0.6  # r/R, counting down from 1.0, until which we change the chord
-    i = 0
-    for radius in radius_nd:
-        if radius >= changes_from:
-            working_mat[i, 2] = working_mat[i, 2] + \
-                chord_addition * ncos_multiplier[i]
-        i += 1
-
-# Negative cosine alteration to chord length, along the blade
-cos_chord_addition = False
-if cos_chord_addition:
-    ncos_multiplier = - np.cos(radius_nd * np.pi)
-    print(ncos_multiplier)
-    chord_addition = 1.0  # [m]
-    working_mat[:, 2] = working_mat[:, 2] + chord_addition * ncos_multiplier
-
-# Blade root twist
-twist_the_root = False
-if twist_the_root:
-    linear_multiplier = - (radius_nd - 1.0)
-    twist_addition = -13.0  # Positive value adds twist [deg]
-    changes_until = 0.25  # r/R until which we change the chord
-    i = 0
-    for radius in radius_nd:
-        if radius <= changes_until:
-            working_mat[i, 1] = working_mat[i, 1] + \
-                twist_addition * linear_multiplier[i]
-        i += 1
-
-# Manual twisting of the root, in order to iteratively achieve a desired
-# angle of attack on the blade
-supertwist_the_root = True
-if supertwist_the_root:
-    # Negative cos multiplier, from [-1, 1]
-    ncos_multiplier = np.cos(radius_nd * np.pi)
-    # 1st design iteration, angle of attack of -2 degrees until 0.4 of r/R
-    # manual_multiplier = [1, 0.80, 0.81, 0.79, 0.55, 0.61, 0.50, 0.45, 0.39, 0.34, 0.32, 0.31, 0.30, 0.3, 0.21, 0.32, 0.17]
-
-    # 2nd design iteration, angle of attack of -2 degrees until 0.25 of r/R
-    manual_multiplier = [1, 0.80, 0.81, 0.79, 0.55, 0.61,
-                         0.50, 0.45, 0.39, 0.34, 0.32, 0.31, 0.30]  # wdr1
-    twist_addition = -64.0  # Positive value adds twist [deg]
-    changes_until = 0.25  # r/R until which we change the chord, change for 1st design iteration
-    i = 0
-    for radius in radius_nd:
-        if radius <= changes_until:
-            working_mat[i, 1] = working_mat[i, 1] + \
-                twist_addition * manual_multiplier[i]
-        i += 1
-
-# Make the root of the blade use a cylindral airfoil
-make_root_cylindrical = False
-if make_root_cylindrical:
-    changes_until = 0.25  # r/R until which we use cylindrical airfoil
-    i = 0
-    for radius in radius_nd:
-        if radius <= changes_until:
-            working_mat[i, 3] = 100.0
-        i += 1
-
-# Plot new chord and twist on top of old
-ax[0].plot(radius_nd, working_mat[:, 2], label=f"{design_name}")
-ax[1].plot(radius_nd, working_mat[:, 1], label=f"{design_name}")
-plt.legend(loc=5)
-
-fig.savefig(f"plots/{design_name}_c_theta.pdf", bbox_inches='tight')
-
-# Format the working_mat twists into the .htc version
-htc_twist = np.interp(twist_radii, working_mat[:, 0], working_mat[:, 1])
-
-
-# %% Creating the new design .htc and ae.dat files
-new_htc_filename = rf"D:\AE EWEM MSc\T H E S I S\6_code\code repository\my_dtu_10mw\{design_name}.htc"
-new_ae_filename = rf"D:\AE EWEM MSc\T H E S I S\6_code\code repository\my_dtu_10mw\data\{design_name}_ae.dat"
-
-try:
-    shutil.copy(htc_file_pathname, new_htc_filename)
-    shutil.copy(ae_file_pathname, new_ae_filename)
-    print("Copied original .htc and ae.dat files successfully.")
-except:
-    print("Copying original .htc and ae.dat files FAILED. Script shutdown.")
-    quit()
-
-# .htc file creation
-# Read the old file
-with open(new_htc_filename, 'r') as new_htc_file:
-    content = new_htc_file.readlines()
-
-# Create what to write in the new file
-with open(new_htc_filename, 'r+') as new_htc_file:
-    for i, line in enumerate(new_htc_file):
+def generate_design(blade, modifiers):
+    """Apply the blade modifiers turned on in `modifiers` to the baseline
+    `blade`, returning the altered .geo format matrix."""
+    working_mat = blade['geo_mat'].copy()
+    radius_nd = blade['radius_nd']
+    cos_pi_r = blade['cos_pi_r']
+    r_minus_one = blade['r_minus_one']
+
+    # r/R increases along the blade, so the sections a modifier acts on are a
+    # slice up to (or from) the section found by a binary search
+    if modifiers["root_linear_chord_addition"]:
+        linear_multiplier = r_minus_one
+        chord_addition = -1.0  # [m]
+        changes_until = 0.25  # r/R until which we change the chord
+        k = np.searchsorted(radius_nd, changes_until, side='right')
+        apply_modifier(working_mat[:k, 2], linear_multiplier[:k],
+                       -chord_addition)
+
+    if modifiers["tip_cos_chord_addition"]:
+        ncos_multiplier = - cos_pi_r
+        chord_addition = - 0.5  # [m]
+        changes_from = 0.6  # r/R, counting down from 1.0, until which we change the chord
+        k = np.searchsorted(radius_nd, changes_from, side='left')
+        apply_modifier(working_mat[k:, 2], ncos_multiplier[k:],
+                       chord_addition)
+
+    if modifiers["cos_chord_addition"]:
+        ncos_multiplier = - cos_pi_r
+        print(ncos_multiplier)
+        chord_addition = 1.0  # [m]
+        apply_modifier(working_mat[:, 2], ncos_multiplier, chord_addition)
+
+    if modifiers["twist_the_root"]:
+        linear_multiplier = - r_minus_one
+        twist_addition = -13.0  # Positive value adds twist [deg]
+        changes_until = 0.25  # r/R until which we change the chord
+        k = np.searchsorted(radius_nd, changes_until, side='right')
+        apply_modifier(working_mat[:k, 1], linear_multiplier[:k],
+                       twist_addition)
+
+    if modifiers["supertwist_the_root"]:
+        manual_multiplier = manual_multiplier_wdr1
+        twist_addition = -64.0  # Positive value adds twist [deg]
+        changes_until = 0.25  # r/R until which we change the chord, change for 1st design iteration
+        k = np.searchsorted(radius_nd, changes_until, side='right')
+        if k > manual_multiplier.size:
+            raise ValueError(
+                f"{k} blade sections lie within r/R <= {changes_until}, but "
+                f"only {manual_multiplier.size} manual twist multipliers "
+                "are given.")
+        apply_modifier(working_mat[:k, 1], manual_multiplier[:k],
+                       twist_addition)
+
+    if modifiers["make_root_cylindrical"]:
+        changes_until = 0.25  # r/R until which we use cylindrical airfoil
+        k = np.searchsorted(radius_nd, changes_until, side='right')
+        working_mat[:k, 3] = 100.0
+
+    return working_mat
+
+
+def create_design(design_name, modifiers, plot_design=False):
+    """Create the `design_name` blade by applying `modifiers` to the original
+    blade and write its .htc and ae.dat files."""
+    blade = load_blade()
+    geo_mat = blade['geo_mat']
+    radius_nd = blade['radius_nd']
+
+    working_mat = generate_design(blade, modifiers)
+
+    # Plot new chord and twist on top of old
+    if plot_design:
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots(2, 1, sharex=True)
+        ax[0].plot(radius_nd, geo_mat[:, 2], label="Baseline")
+        ax[0].plot(radius_nd, working_mat[:, 2], label=f"{design_name}")
+        ax[0].set_ylabel("Chord [m]")
+
+        ax[1].plot(radius_nd, geo_mat[:, 1], label="Baseline")
+        ax[1].plot(radius_nd, working_mat[:, 1], label=f"{design_name}")
+        ax[1].set_ylabel("Twist [deg]")
+        ax[1].set_xlabel("Blade radius r/R [-]")
+        plt.legend(loc=5)
+
+        fig.savefig(f"plots/{design_name}_c_theta.pdf", bbox_inches='tight')
+        plt.close(fig)
+
+    # Format the working_mat twists into the .htc version
+    htc_twist = np.interp(blade['twist_radii'], working_mat[:, 0],
+                          working_mat[:, 1])
+
+    # Creating the new design .htc and ae.dat files
+    new_htc_filename = rf"D:\AE EWEM MSc\T H E S I S\6_code\code repository\my_dtu_10mw\{design_name}.htc"
+    new_ae_filename = rf"D:\AE EWEM MSc\T H E S I S\6_code\code repository\my_dtu_10mw\data\{design_name}_ae.dat"
+
+    # .htc file creation
+    # Start from the lines of the original file
+    htc_content = list(blade['htc_lines'])
+
+    # Create what to write in the new file
+    htc_twist_strs = np.char.mod("%.10g", htc_twist)
+    for i, line in enumerate(htc_content):
         if "ae_filename" in line:
-            content[i] = f"\tae_filename ./data/{design_name}_ae.dat;\n"
-        if i >= htc_start_line and i < htc_end_line:
-            line = line.strip().split(" ")
-            if "" in line:
-                # In single-digit sections there can be a whitespace
-                line.remove("")
-            line[4] = str(htc_twist[i-htc_start_line]) + ";\n"
-            line = "\t\t" + ' '.join(line)
-            content[i] = line
-
-# Write the new file
-with open(new_htc_filename, 'w') as new_htc_file:
-    new_htc_file.writelines(content)
-
-# ae.dat file creation
-# Read the old file
-with open(new_ae_filename, 'r') as new_ae_file:
-    content = new_ae_file.readlines()
-
-# Create what to write in the new file
-with open(new_ae_filename, 'r+') as new_ae_file:
-    for i, line in enumerate(new_ae_file):
-        if i >= ae_start_line:
-            line = line.strip().split("\t")
-            line[0] = str(working_mat[i - ae_start_line, 0])
-            line[1] = str(working_mat[i - ae_start_line, 2])
-            line[2] = str(working_mat[i - ae_start_line, 3])
-            line = '\t'.join(line) + "\n"
-            content[i] = line
-
-# Write the new file
-with open(new_ae_filename, 'w') as new_ae_file:
-    new_ae_file.writelines(content)
-
-# %% Run HAWC2S
+            htc_content[i] = f"\tae_filename ./data/{design_name}_ae.dat;\n"
+    for k, i in enumerate(range(htc_start_line, htc_end_line)):
+        htc_content[i] = htc_twist_pattern.sub(
+            rf"\g<1>{htc_twist_strs[k]}", htc_content[i], count=1)
+
+    # ae.dat file creation
+    # Keep the header lines of the original file. Radius, chord and relative
+    # thickness are replaced, the remaining columns are taken over as they
+    # were parsed from the original file
+    r_strs = np.char.mod("%.10g", working_mat[:, 0])
+    c_strs = np.char.mod("%.10g", working_mat[:, 2])
+    t_strs = np.char.mod("%.10g", working_mat[:, 3])
+    ae_content = list(blade['ae_header']) + [
+        "\t".join((r, c, t, *rest_cols)) + "\n"
+        for r, c, t, rest_cols in zip(r_strs, c_strs, t_strs,
+                                      blade['ae_data_extra_cols'])]
+
+    # Write the new files
+    try:
+        write_files({new_htc_filename: htc_content,
+                     new_ae_filename: ae_content})
+        print("Created new .htc and ae.dat files successfully.")
+    except OSError as error:
+        print(f"Creating new .htc and ae.dat files FAILED ({error}). Script shutdown.")
+        raise SystemExit(1)
 
-h2s.run_hawc2s(design_name)
 
-h2s.pp_hawc2s_ind(design_name, U=U)
-
-h2s.pp_hawc2s_pwr(design_name)
-
-h2s.pp_hawc2s_bladepower(design_name)
-
-if save_design:
-    h2s.hawc2s_files_to_geo(design_name)
+# %% Run HAWC2S
+def pp_hawc2s_design(design_name, U=U, save_design=True):
+    """Post-process the HAWC2S results of a design that has been run."""
+    # Same as in `h2s.run_hawc2s`, the results are found relative to the
+    # folder with the .htc files, also when HAWC2S ran in a worker process
+    if 'my_dtu_10mw' not in os.getcwd():
+        os.chdir('my_dtu_10mw')
+
+    h2s.pp_hawc2s_ind(design_name, U=U)
+
+    h2s.pp_hawc2s_pwr(design_name)
+
+    h2s.pp_hawc2s_bladepower(design_name)
+
+    if save_design:
+        h2s.hawc2s_files_to_geo(design_name)
+
+
+def main(designs, U=U, save_design=True, plot_design=False):
+    """Create every design in `designs`, a dict of design names and their
+    modifiers, and evaluate them with HAWC2S."""
+    for design_name, modifiers in designs.items():
+        create_design(design_name, modifiers, plot_design=plot_design)
+
+    design_names = list(designs)
+    n_designs = len(design_names)
+    if n_designs == 1:
+        h2s.run_hawc2s(design_names[0])
+    elif n_designs > 1:
+        # The designs are independent, so their HAWC2S runs are spread over
+        # separate processes
+        max_workers = max(1, min(n_designs, os.cpu_count() or 1))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(h2s.run_hawc2s, design_names))
+
+    # Post-processing prints and plots, so it stays in this process
+    for design_name in design_names:
+        pp_hawc2s_design(design_name, U=U, save_design=save_design)
+
+
+if __name__ == '__main__':
+    # To change the DTU10MW blade design, use any combination of the below
+    # blade modifiers by  turning them 'on' by setting them to `True`
+    modifiers = {
+        # Linearly changing addition to chord length
+        "root_linear_chord_addition": True,
+        # Negative cosine alteration to chord length, at the tip
+        "tip_cos_chord_addition": False,
+        # Negative cosine alteration to chord length, along the blade
+        "cos_chord_addition": False,
+        # Blade root twist
+        "twist_the_root": False,
+        # Manual twisting of the root, in order to iteratively achieve a
+        # desired angle of attack on the blade
+        "supertwist_the_root": True,
+        # Make the root of the blade use a cylindral airfoil
+        "make_root_cylindrical": False,
+    }
+
+    # Designs to create and evaluate, the original blade is parsed only once
+    designs = {"WDR_10_MW": modifiers}
+
+    main(designs, save_design=True, plot_design=False)